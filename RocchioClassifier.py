@@ -7,9 +7,11 @@ from __future__ import division
     The basic idea here is to represent each document as a vector of counts 
     of ngrams.
     
-        - The vectors are normalized to length 1
         - Centroids are calculated for the positive training documents and 
-          negative training documents
+          negative training documents from per-class ngram document 
+          frequencies and sums of log term frequencies so that training is
+          incremental. Unlike the textbook method, the document vectors are 
+          not normalized before they are summed.
         - New documents are classified by which of the two centroids they
           are closer to.
         - In the current implementation, the distance measure is cosine.
@@ -18,11 +20,87 @@ from __future__ import division
     vectors are all sparse with element values rarely greater than 1.
 
 """
-import math
+import math, multiprocessing
+from collections import Counter
+import numpy as np
 import preprocessing
 
 EPSILON = 1.0e-6
 
+# Training sets smaller than this are not worth starting worker processes for
+MIN_PARALLEL_TRAINING = 10000
+
+def _get_example_tfs(example):
+    """Return cls,tfs for training example = cls,message where
+            tfs[n] = grams,vals are the unique ngrams in message and 
+                vals[i] = 1 + log10(number of occurrences of grams[i] in message)
+        or None if message has no words.
+        
+        This is top-level so that it can be run in multiprocessing workers.
+    """
+    cls,message = example
+    words = preprocessing.extract_words(message)
+    if not words:
+        return None
+    
+    ngrams = RocchioClassifier.get_all_ngrams(words)
+    tfs = {}
+    for n in (1,2,3):
+        counts = Counter(ngrams[n])
+        # term frequency ~ log10(number of occurrences of word in doc)
+        vals = 1.0 + np.log10(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+        tfs[n] = list(counts.keys()), vals
+    return cls, tfs
+
+def _merge_weighted_cos(q_ids, q_vals, c_ids, c_vals, weight):
+    """Return weight * the dot product of sparse vectors (q_ids,q_vals) and 
+        (c_ids,c_vals). q_ids and c_ids must be sorted in increasing order.
+        
+        This is a merge-intersection of the two id arrays so it does no 
+        hashing. Queries are much shorter than centroids so the centroid 
+        pointer is advanced by binary search rather than one element at a 
+        time, which makes this O(len(q_ids) * log(len(c_ids))).
+    """
+    total = 0.0
+    i = 0
+    j = 0
+    while i < q_ids.shape[0] and j < c_ids.shape[0]:
+        if q_ids[i] < c_ids[j]:
+            i += 1
+        elif q_ids[i] > c_ids[j]:
+            j += np.searchsorted(c_ids[j:], q_ids[i])
+        else:
+            total += q_vals[i] * c_vals[j]
+            i += 1
+            j += 1
+    return weight * total
+
+def _numpy_weighted_cos(q_ids, q_vals, c_ids, c_vals, weight):
+    """Return weight * the dot product of sparse vectors (q_ids,q_vals) and 
+        (c_ids,c_vals). c_ids must be sorted in increasing order.
+        
+        Without numba a Python merge loop over the centroid is slower than a 
+        binary search of the centroid for each query id
+    """
+    if not len(c_ids):
+        return 0.0
+    pos = np.minimum(np.searchsorted(c_ids, q_ids), len(c_ids) - 1)
+    match = c_ids[pos] == q_ids
+    return weight * float(np.dot(q_vals[match], c_vals[pos[match]]))
+
+# Use the fastest weighted_cos available: the Cython one in _rocchio_core.pyx,
+# then _merge_weighted_cos compiled by numba, then _numpy_weighted_cos
+try:
+    import pyximport
+    pyximport.install()
+    from _rocchio_core import weighted_cos
+except ImportError:
+    try:
+        from numba import njit
+        weighted_cos = njit(cache=True)(_merge_weighted_cos)
+    except ImportError:
+        weighted_cos = _numpy_weighted_cos
+
 class RocchioClassifier:
     
     # Precision = 0.936, Recall = 0.606, F1 = 0.736
@@ -64,130 +142,206 @@ class RocchioClassifier:
         return dict((n,w/total) for n,w in weights.items())     
     
     @staticmethod
-    def build_inv_index(documents):
-        """Build an inverted index of the documents.
-            inv_index[word][i] = number of occurences of word in documents[i]
+    def get_all_ngrams(words):
+        """Return preprocessing.get_ngrams(n, words) for n = 1,2,3 as a dict 
+            keyed by n, built with one zip over words for each n rather than 
+            slicing words for every ngram.
         """
+        join = preprocessing.WORD_DELIMITER.join
+        # get_ngrams() omits the ngrams ending with the last word ([TAG_END])
+        body = words[:-1]
+        return {
+            1 : [w for w in words[1:-1] if w != 'PAPER_CUT'],
+            2 : [join(g) for g in zip(body, body[1:])],
+            3 : [join(g) for g in zip(body, body[1:], body[2:])]
+        }
         
-        inv_index = {}
-  
-        for i,doc in enumerate(documents):
-            for word in doc:
-                if not word in inv_index.keys():
-                    inv_index[word] = {}
-        return inv_index
-       
     @staticmethod
-    def compute_tfidf(documents):
-        """Build a tf-idf dict for documents
-            tfidf[word][i] = tf-idf for word and document with index i
+    def get_resized(arr, size):
+        """Return a copy of arr with at least size elements, padded with zeros.
+            Capacity is doubled so that growing arr one ngram at a time 
+            takes amortized constant time.
         """
-        
-        inv_index = RocchioClassifier.build_inv_index(documents)
-       
-        tfidf = {}
-        logN = math.log(len(documents), 10)
-        for word in inv_index:
-            # word_doc_counts[i] = number of occurences of word in documents[i]
-            word_doc_counts = inv_index[word] 
-            # inverse document frequency ~ -log10(number of documents that word occurs in)
-            idf = logN - math.log(len(word_doc_counts), 10)
-            for doc_idx,word_count in word_doc_counts.items():
-                if word not in tfidf:
-                    tfidf[word] = {}
-                # term frequency ~ log10(number of occurrences of word in doc)    
-                tf = 1.0 + math.log(word_count, 10)
-                tfidf[word][doc_idx] = tf * idf 
-       
-        # Calculate per-document l2 norms for use in cosine similarity
-        # tfidf_l2norm[d] = sqrt(sum[tdidf**2])) for tdidf of all words in 
-        # document number d
-        tfidf_l2norm2 = {}
-        for word, doc_indexes in tfidf.items():
-            for doc_idx,val in doc_indexes.items():
-                tfidf_l2norm2[doc_idx] = tfidf_l2norm2.get(doc_idx, 0.0) + val ** 2
-        tfidf_l2norm = dict((doc_idx,math.sqrt(val)) for doc_idx,val in tfidf_l2norm2.items())   
-
-        return tfidf, tfidf_l2norm
+        resized = np.zeros(max(size, 2 * len(arr)), dtype=arr.dtype)
+        resized[:len(arr)] = arr
+        return resized
     
     @staticmethod
-    def get_centroid(vocabulary, documents):
-        tfidf,tfidf_l2norm = RocchioClassifier.compute_tfidf(documents)
-    
-        N = len(documents)
-        return dict((word, sum(tfidf[word])/N) for word in tfidf)
- 
-        def get_normalized_sum(word):
-            if word not in tfidf: 
-                return 0.0
-            return sum(tfidf[word][doc_idx]/tfidf_l2norm[doc_idx] for doc_idx in tfidf[word] if tfidf[word][doc_idx]) 
+    def get_centroid(V, N, df, tf_sum):
+        """Return the tf-idf centroid of the N documents of a class as a dense 
+            array indexed by ngram id
+                V: vocabulary size
+                df[word] = number of documents that ngram id word occurs in
+                tf_sum[word] = sum of log term frequencies of word over documents
+            df and tf_sum are arrays indexed by ngram id that may be shorter or
+            longer than V.
+            The centroid of no documents is the zero vector.
+        """
+        centroid = np.zeros(V)
+        if not N:
+            return centroid
+        
+        ids = np.flatnonzero(df[:V])
         
-        return dict((word, get_normalized_sum(word)/N) for word in vocabulary)
+        # inverse document frequency ~ -log10(number of documents that word occurs in)
+        idf = np.log10(N/df[ids])
+        centroid[ids] = tf_sum[ids] * idf / N
+        return centroid
         
     @staticmethod
-    def get_query_vec(ngrams):
-        # Construct the query vector as a dict word:log(tf)
-        query_vec = {}
-        for word in ngrams: 
-            query_vec[word] = query_vec.get(word,0) + 1
-        return dict((word, math.log(query_vec[word], 10) + 1.0) for word in query_vec)
+    def get_sparse_vec(vec):
+        """Return dense vector vec as parallel arrays of the sorted ids of its 
+            non-zero elements and their values. The values are stored as 
+            float32 which halves the memory they take and is more than enough
+            precision for cosine distances.
+        """
+        ids = np.flatnonzero(vec).astype(np.int32)
+        return ids, vec[ids].astype(np.float32)
         
     @staticmethod
-    def get_distance(centroid, query_vec):
-        # Return the distance between query_vec and centroid
-        centroid_vec = dict((word, centroid.get(word,0.0)) for word in query_vec)  
-        # Return the cosine    
-        # ~!@# Assume some normalization somewhere
-        return sum(query_vec[word] * centroid_vec[word] for word in query_vec)    
+    def get_dense_vec(V, sparse_vec):
+        """Inverse of get_sparse_vec() for a vocabulary of size V"""
+        ids,vals = sparse_vec
+        vec = np.zeros(V)
+        vec[ids] = vals
+        return vec
+    
+    @staticmethod
+    def get_inv_norm(vals):
+        """Return 1/l2 norm of vals, or 0 for an all-zero vector"""
+        norm = float(np.linalg.norm(vals))
+        return 1.0/norm if norm else 0.0
+    
+    @staticmethod
+    def get_query_vec(ngram_id, ngrams):
+        # Construct the query vector as parallel arrays of sorted ngram ids and 
+        # log(tf)
+        # ngrams that are not in the training vocabulary have a centroid value
+        # of zero so they are dropped. They are looked up with one probe each
+        # as id -1 and removed in one numpy pass.
+        get_id = ngram_id.get
+        ids = np.fromiter((get_id(g, -1) for g in ngrams), dtype=np.int32, count=len(ngrams))
+        ids,counts = np.unique(ids[ids >= 0], return_counts=True)
+        vals = 1.0 + np.log10(counts)
+        return ids, vals
+        
+    @staticmethod
+    def get_distance(centroid, centroid_inv_norm, query_vec, query_inv_norm, weight=1.0):
+        # Return the weighted cosine between query_vec and centroid
+        # The inverse norms are computed once per centroid and once per query
+        q_ids,q_vals = query_vec
+        c_ids,c_vals = centroid
+        return weighted_cos(q_ids, q_vals, c_ids, c_vals, weight * query_inv_norm * centroid_inv_norm)
     
     def __init__(self, training_data):
         """RocchioClassifier initialization
+            ngram_id[n][word] is the integer id of ngram word for ngram size n. 
+                Ids are assigned in the order ngrams are first seen so the 
+                vocabulary for ngram size n is range(len(ngram_id[n]))
+            doc_count[cls] is the number of training documents of class cls
+            df[n][cls][word] is the number of training documents of class cls
+                that ngram id word occurs in
+            tf_sum[n][cls][word] is the sum of 1 + log10(number of occurrences 
+                of ngram id word in document) over training documents of class 
+                cls
+                df[n][cls] and tf_sum[n][cls] are arrays indexed by ngram id 
+                with spare capacity from get_resized()
+            pos_centroid[n] and neg_centroid[n] are (ids,vals) arrays of the 
+                non-zero centroid elements from get_sparse_vec()
+            pos_centroid_inv_norm[n] and neg_centroid_inv_norm[n] are 1/l2 norms
+                of the centroids
         """
-        self.pos_documents = dict((n,[]) for n in (1,2,3))
-        self.neg_documents = dict((n,[]) for n in (1,2,3))
-        self.vocab = dict((n,set()) for n in (1,2,3))
-        self.pos_centroid = dict((n,{}) for n in (1,2,3))
-        self.neg_centroid = dict((n,{}) for n in (1,2,3))
+        self.ngram_id = dict((n,{}) for n in (1,2,3))
+        self.doc_count = [0,0]
+        self.df = dict((n,[np.zeros(0, dtype=np.int32) for cls in (0,1)]) for n in (1,2,3))
+        self.tf_sum = dict((n,[np.zeros(0) for cls in (0,1)]) for n in (1,2,3))
+        self.pos_centroid = dict((n,None) for n in (1,2,3))
+        self.neg_centroid = dict((n,None) for n in (1,2,3))
+        self.pos_centroid_inv_norm = dict((n,0.0) for n in (1,2,3))
+        self.neg_centroid_inv_norm = dict((n,0.0) for n in (1,2,3))
        
         self.train(training_data)
         
     def __repr__(self):
         
-        def show_pos_neg(n, vocab, pos_centroid, neg_centroid):
-            def pn(word):
-                p = pos_centroid.get(word, 0.0)
-                n = neg_centroid.get(word, 0.0)
-                return '%6.4f - %6.4f = %7.4f %s' % (p, n, p-n, word)
-            def order(word):
-                return neg_centroid.get(word, 0.0) - pos_centroid.get(word, 0.0)
-            return 'pos neg n=%d\n%s' % (n, '\n'.join(pn(word) for word in sorted(vocab, key = order)))
+        def show_pos_neg(n, ngram_id, pos_centroid, neg_centroid):
+            pos_centroid = RocchioClassifier.get_dense_vec(len(ngram_id), pos_centroid)
+            neg_centroid = RocchioClassifier.get_dense_vec(len(ngram_id), neg_centroid)
+            # words[i] is the ngram with id i
+            words = [None] * len(ngram_id)
+            for word,i in ngram_id.items():
+                words[i] = word
+            def pn(i):
+                p = pos_centroid[i]
+                n = neg_centroid[i]
+                return '%6.4f - %6.4f = %7.4f %s' % (p, n, p-n, words[i])
+            # Sort the whole vocabulary once in numpy rather than with a Python key function
+            order = np.argsort(neg_centroid - pos_centroid, kind='mergesort')
+            return 'pos neg n=%d\n%s' % (n, '\n'.join(pn(i) for i in order))
         
-        return '\n'.join(show_pos_neg(n, self.vocab[n], self.pos_centroid[n], self.neg_centroid[n]) 
+        return '\n'.join(show_pos_neg(n, self.ngram_id[n], self.pos_centroid[n], self.neg_centroid[n]) 
             for n in (3,2,1)) 
 
-    def _add_example(self, cls, message):
-        """Add a training example
+    def _add_example_tfs(self, cls, tfs):
+        """Add a training example by updating the per-class counts in one pass
+            over its ngrams. tfs is from _get_example_tfs()
         """
-
-        words = preprocessing.extract_words(message)
-        if not words:
-            return
-  
-        documents = self.pos_documents if cls else self.neg_documents
+        self.doc_count[cls] += 1
         
         for n in (1,2,3):
-            ngrams = preprocessing.get_ngrams(n, words)
-            documents[n].append(ngrams)
-            for g in ngrams:
-                self.vocab[n].add(g)
+            id_dict = self.ngram_id[n]
+            # The ngrams in tfs[n] are unique so ids has no repeats
+            grams,vals = tfs[n]
+            ids = np.fromiter((id_dict.setdefault(g, len(id_dict)) for g in grams), 
+                                dtype=np.int32, count=len(grams))
+            
+            V = len(id_dict)
+            if len(self.df[n][cls]) < V:
+                self.df[n][cls] = RocchioClassifier.get_resized(self.df[n][cls], V)
+                self.tf_sum[n][cls] = RocchioClassifier.get_resized(self.tf_sum[n][cls], V)
+            self.df[n][cls][ids] += 1
+            self.tf_sum[n][cls][ids] += vals
+
+    def _add_example(self, cls, message):
+        """Add a training example
+        """
+        example_tfs = _get_example_tfs((cls, message))
+        if example_tfs:
+            self._add_example_tfs(*example_tfs)
  
     def train(self, training_data):
-        for cls,message in training_data:
-            self._add_example(cls, message)
+        """Add training_data to the model. This can be called again with more 
+            training data without revisiting the earlier examples.
             
+            Large training sets are preprocessed in a pool of worker processes
+            and the per-example ngram counts are reduced in this process.
+        """
+        training_data = list(training_data)
+        num_workers = multiprocessing.cpu_count()
+        
+        if num_workers > 1 and len(training_data) >= MIN_PARALLEL_TRAINING:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                chunksize = int(math.ceil(len(training_data)/num_workers))
+                for example_tfs in pool.imap_unordered(_get_example_tfs, training_data, chunksize):
+                    if example_tfs:
+                        self._add_example_tfs(*example_tfs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for cls,message in training_data:
+                self._add_example(cls, message)
+            
+        neg,pos = self.doc_count
         for n in (1,2,3):
-            self.pos_centroid[n] = RocchioClassifier.get_centroid(self.vocab[n], self.pos_documents[n])
-            self.neg_centroid[n] = RocchioClassifier.get_centroid(self.vocab[n], self.neg_documents[n])
+            V = len(self.ngram_id[n])
+            self.pos_centroid[n] = RocchioClassifier.get_sparse_vec(
+                RocchioClassifier.get_centroid(V, pos, self.df[n][True], self.tf_sum[n][True]))
+            self.neg_centroid[n] = RocchioClassifier.get_sparse_vec(
+                RocchioClassifier.get_centroid(V, neg, self.df[n][False], self.tf_sum[n][False]))
+            self.pos_centroid_inv_norm[n] = RocchioClassifier.get_inv_norm(self.pos_centroid[n][1])
+            self.neg_centroid_inv_norm[n] = RocchioClassifier.get_inv_norm(self.neg_centroid[n][1])
 
     def classify(self, message, detailed=False):
         """ 
@@ -211,18 +365,36 @@ class RocchioClassifier:
             return False, 0.0
         
         # Best intuition would be to compute back-off based on counts
-        ngrams = dict((n,preprocessing.get_ngrams(n, words)) for n in (1,2,3))
+        ngrams = RocchioClassifier.get_all_ngrams(words)
+        
+        # The ngram sizes are always 1,2,3 so the per-n distances are written
+        # out rather than built up in dicts for each message
+        get_query_vec = RocchioClassifier.get_query_vec
+        get_inv_norm = RocchioClassifier.get_inv_norm
+        get_distance = RocchioClassifier.get_distance
         
-        query_vecs = dict((n, RocchioClassifier.get_query_vec(ngrams[n])) for n in (1,2,3))
+        query_vec1 = get_query_vec(self.ngram_id[1], ngrams[1])
+        query_vec2 = get_query_vec(self.ngram_id[2], ngrams[2])
+        query_vec3 = get_query_vec(self.ngram_id[3], ngrams[3])
+        query_inv_norm1 = get_inv_norm(query_vec1[1])
+        query_inv_norm2 = get_inv_norm(query_vec2[1])
+        query_inv_norm3 = get_inv_norm(query_vec3[1])
     
-        weights = RocchioClassifier.get_weights()   
+        # Same as get_weights()
+        total = 1.0 + RocchioClassifier.weight_bigrams + RocchioClassifier.weight_trigrams
+        weight1 = 1.0/total
+        weight2 = RocchioClassifier.weight_bigrams/total
+        weight3 = RocchioClassifier.weight_trigrams/total
         
-                    
-        def get_weighted_distance(centroid):
-            return sum(RocchioClassifier.get_distance(centroid[n], query_vecs[n]) * weights[n] for n in (1,2,3))
+        pos_centroid, pos_inv_norm = self.pos_centroid, self.pos_centroid_inv_norm
+        neg_centroid, neg_inv_norm = self.neg_centroid, self.neg_centroid_inv_norm
 
-        pos_distance = get_weighted_distance(self.pos_centroid)
-        neg_distance = get_weighted_distance(self.neg_centroid)
+        pos_distance = get_distance(pos_centroid[1], pos_inv_norm[1], query_vec1, query_inv_norm1, weight1) \
+                     + get_distance(pos_centroid[2], pos_inv_norm[2], query_vec2, query_inv_norm2, weight2) \
+                     + get_distance(pos_centroid[3], pos_inv_norm[3], query_vec3, query_inv_norm3, weight3)
+        neg_distance = get_distance(neg_centroid[1], neg_inv_norm[1], query_vec1, query_inv_norm1, weight1) \
+                     + get_distance(neg_centroid[2], neg_inv_norm[2], query_vec2, query_inv_norm2, weight2) \
+                     + get_distance(neg_centroid[3], neg_inv_norm[3], query_vec3, query_inv_norm3, weight3)
 
         diff = (pos_distance + EPSILON)/(neg_distance + EPSILON)
         return diff > RocchioClassifier.threshold, math.log(diff)
@@ -0,0 +1,55 @@
+"""
+    Compiled kernels for RocchioClassifier
+    
+    This is built on import by pyximport with the compiler flags in 
+    _rocchio_core.pyxbld. RocchioClassifier falls back to numba or numpy 
+    versions of these functions when it can't be built.
+"""
+cimport cython
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double sparse_dot(const int[:] qi, const double[:] qv, 
+                              const int[:] ci, const float[:] cv) nogil:
+    """Return the dot product of sparse vectors (qi,qv) and (ci,cv) whose ids
+        qi and ci are sorted in increasing order. 
+        
+        This is a merge-intersection of the id arrays where the centroid 
+        pointer j is advanced by binary search as in 
+        RocchioClassifier._merge_weighted_cos()
+    """
+    cdef Py_ssize_t i = 0, j = 0, lo, hi, mid
+    cdef Py_ssize_t nq = qi.shape[0], nc = ci.shape[0]
+    cdef double total = 0.0
+    
+    while i < nq and j < nc:
+        if qi[i] < ci[j]:
+            i += 1
+        elif qi[i] > ci[j]:
+            # First index >= j whose id is >= qi[i]
+            lo = j + 1
+            hi = nc
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if ci[mid] < qi[i]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            j = lo
+        else:
+            total += qv[i] * cv[j]
+            i += 1
+            j += 1
+    return total
+
+def weighted_cos(const int[:] q_ids, const double[:] q_vals, 
+                 const int[:] c_ids, const float[:] c_vals, double weight):
+    """Return weight * the dot product of sparse vectors (q_ids,q_vals) and 
+        (c_ids,c_vals). q_ids and c_ids must be sorted in increasing order.
+        
+        The GIL is released while the dot product is computed.
+    """
+    cdef double total
+    with nogil:
+        total = sparse_dot(q_ids, q_vals, c_ids, c_vals)
+    return weight * total
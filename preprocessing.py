@@ -174,10 +174,32 @@ def get_ngrams(n, words):
 import PorterStemmer    
 stemmer = PorterStemmer.PorterStemmer()    
 
+# extract_words() results are memoized as the same messages are classified 
+#  many times in cross-validation and parameter optimization. The cache is 
+#  emptied when it reaches EXTRACT_WORDS_CACHE_SIZE entries.
+EXTRACT_WORDS_CACHE_SIZE = 10000
+_extract_words_cache = {}
+
 def extract_words(message, do_stem = False):
     """The word extractor that is run over every message that is trained on or
         classified or None if 'paper cut' was removed in processing.
+        
+        The returned list is shared between calls with the same message so
+        callers must not modify it.
     """
+    key = (message, do_stem)
+    if key in _extract_words_cache:
+        return _extract_words_cache[key]
+    
+    words = _extract_words(message, do_stem)
+    
+    if len(_extract_words_cache) >= EXTRACT_WORDS_CACHE_SIZE:
+        _extract_words_cache.clear()
+    _extract_words_cache[key] = words
+    return words
+
+def _extract_words(message, do_stem):
+    """Uncached extract_words()"""
     message = message.lower()
     
     if do_stem: